@@ -1,27 +1,39 @@
 #!/usr/bin/env python3
 
 import datetime
+import functools
 import hashlib
 import icalendar
 import os
-import pytz
+import re
 import requests
 import uuid
 
-from bs4 import BeautifulSoup
-from typing import List, Dict
+from dataclasses import dataclass
+from html import unescape
+from requests.adapters import HTTPAdapter
+from typing import List, Dict, Tuple
+from zoneinfo import ZoneInfo
 
 CALENDAR_PAGE_URL = 'https://m.grundfoskoret.dk/korkalender'
 USERNAME = os.environ.get('GRUNDFOSKORET_USERNAME')
 PASSWORD = os.environ.get('GRUNDFOSKORET_PASSWORD')
+REQUEST_TIMEOUT = (5, 30)
 
-TIMEZONE = pytz.timezone("Europe/Copenhagen")
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+TIMEZONE = ZoneInfo("Europe/Copenhagen")
 
 SRC_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(SRC_DIR)
 DATA_DIR = os.path.join(ROOT_DIR, "data")
 ICS_FILENAME = os.path.join(DATA_DIR, "grundfoskoret.ics")
 
+MIN_YEAR = 2023
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
 MONTH_MAP = {
     'januar': 1,
     'februar': 2,
@@ -37,109 +49,128 @@ MONTH_MAP = {
     'december': 12
 }
 
-
-def parse_date(date_text: str) -> Dict[str, any]:
+_LOCALIZE_CACHE: Dict[Tuple[int, int, int, int, int], datetime.datetime] = {}
+
+# Each event is an element with the calendar-event-title class whose
+# children are the title text, an element holding the date and an element
+# holding the time, e.g.
+#
+#   <div class="calendar-event-title">Korprøve<span>Tirsdag d. 5. marts 2024</span><span>19:00 - 21:30</span></div>
+#
+# The class must appear as a whole, whitespace-separated token of the class
+# attribute (whose name is case-insensitive), and the attribute may be
+# double-quoted, single-quoted or unquoted.
+EVENT_RE = re.compile(
+    r'(?<![\w-])(?i:class)\s*=\s*(?:'
+    r'"(?:[^"]*\s)?calendar-event-title(?:\s[^"]*)?"'
+    r"|'(?:[^']*\s)?calendar-event-title(?:\s[^']*)?'"
+    r'|calendar-event-title(?=[\s/>])'
+    r')[^>]*>'
+    r'([^<]*)'
+    r'<[^/>][^>]*>([^<]*)</[^>]*>\s*'
+    r'<[^/>][^>]*>([^<]*)</'
+)
+
+CANCELLED_RE = re.compile(r'aflyst', re.IGNORECASE)
+
+
+@dataclass(frozen=True, slots=True)
+class Event:
+    title: str
+    start: datetime.datetime
+    end: datetime.datetime
+    cancelled: bool
+
+
+@functools.lru_cache(maxsize=512)
+def parse_date(date_text: str) -> Tuple[Tuple[int, int, int], Tuple[int, int, int]]:
     if " - " in date_text:
         return parse_double_date(date_text)
     else:
-        return {
-            **parse_single_date(date_text, 'start_'),
-            **parse_single_date(date_text, 'end_'),
-        }
+        date = parse_single_date(date_text)
+        return (date, date)
 
 
-def parse_double_date(date_text: str) -> Dict[str, any]:
+def parse_double_date(date_text: str) -> Tuple[Tuple[int, int, int], Tuple[int, int, int]]:
     (start_text, end_text) = date_text.split(" - ")
-    return {
-        **parse_single_date(start_text, 'start_'),
-        **parse_single_date(end_text, 'end_'),
-    }
+    return (parse_single_date(start_text), parse_single_date(end_text))
 
 
-def parse_single_date(date_text: str, prefix: str = '') -> Dict[str, any]:
-    date_text = date_text.partition("d. ")[2]
-    (day_text, month_name, year_text) = date_text.split(" ")
-    day = int(day_text.replace(".", ""))
-    month = MONTH_MAP[month_name.lower()]
+def parse_single_date(date_text: str) -> Tuple[int, int, int]:
+    (day_text, month_name, year_text) = date_text.partition("d. ")[2].lower().split(" ", 2)
+    day = int(day_text.rstrip("."))
+    month = MONTH_MAP[month_name]
     year = int(year_text)
 
-    return {prefix + 'day': day, prefix + 'month': month, prefix + 'year': year}
+    return (year, month, day)
 
 
-def parse_time(time_text: str) -> Dict[str, any]:
+@functools.lru_cache(maxsize=512)
+def parse_time(time_text: str) -> Tuple[int, int, int, int]:
     (start_text, end_text) = time_text.split(" - ")
     (start_hour, start_min) = [int(x) for x in start_text.split(":")]
     (end_hour, end_min) = [int(x) for x in end_text.split(":")]
 
-    return {'start_hour': start_hour, 'start_minute': start_min,
-            'end_hour': end_hour, 'end_minute': end_min}
+    return (start_hour, start_min, end_hour, end_min)
 
 
-def parse_events(html: str) -> List[Dict[str, any]]:
-    soup = BeautifulSoup(html, 'html.parser')
+def _localize(year: int, month: int, day: int, hour: int, minute: int) -> datetime.datetime:
+    key = (year, month, day, hour, minute)
+    localized = _LOCALIZE_CACHE.get(key)
+    if localized is None:
+        localized = datetime.datetime(
+            year=year, month=month, day=day, hour=hour, minute=minute, tzinfo=TIMEZONE
+        )
+        _LOCALIZE_CACHE[key] = localized
+
+    return localized
 
-    result = []
-    for elem in soup.select('.calendar-event-title'):
-        if len(elem.contents) < 3:
-            continue
 
-        title = elem.contents[0]
+def parse_events(html: str) -> List[Event]:
+    result = []
+    append = result.append
+    localize = _localize
+    for (title, date_text, time_text) in EVENT_RE.findall(html):
+        title = unescape(title)
         if not title:
             continue
 
-        date_text = elem.contents[1].contents[0]
+        date_text = unescape(date_text)
         if not date_text:
             continue
 
-        date_data = parse_date(date_text)
-        if date_data['start_year'] < 2023:
+        # The last word is the (end) year, so old events can be skipped
+        # without parsing the full date
+        if int(date_text.rsplit(" ", 1)[1]) < MIN_YEAR:
+            continue
+
+        ((start_year, start_month, start_day), (end_year, end_month, end_day)) = parse_date(date_text)
+        if start_year < MIN_YEAR:
             continue
 
-        time_text = elem.contents[2].contents[0]
+        time_text = unescape(time_text)
         if not time_text:
             continue
 
-        time_data = parse_time(time_text)
+        (start_hour, start_minute, end_hour, end_minute) = parse_time(time_text)
 
-        start_datetime = TIMEZONE.localize(datetime.datetime(
-            year=date_data['start_year'],
-            month=date_data['start_month'],
-            day=date_data['start_day'],
-            hour=time_data['start_hour'],
-            minute=time_data['start_minute']
-        ))
+        start_datetime = localize(start_year, start_month, start_day, start_hour, start_minute)
+        end_datetime = localize(end_year, end_month, end_day, end_hour, end_minute)
 
-        end_datetime = TIMEZONE.localize(datetime.datetime(
-            year=date_data['end_year'],
-            month=date_data['end_month'],
-            day=date_data['end_day'],
-            hour=time_data['end_hour'],
-            minute=time_data['end_minute']
+        append(Event(
+            title=title,
+            start=start_datetime,
+            end=end_datetime,
+            cancelled=CANCELLED_RE.search(title) is not None
         ))
 
-        if title and date_text and time_text:
-            result.append({
-                'title': title,
-                'start': start_datetime,
-                'end': end_datetime,
-                'cancelled': "aflyst" in title.lower()
-            })
-
     return result
 
 
-def get_uuid(dt: datetime, counter_map: Dict[str, int]) -> str:
-    date_part = dt.date().isoformat()
-
-    counter = counter_map.get(date_part, 0)
-    counter = counter + 1
-    counter_map[date_part] = counter
-
-    unique_value = '%s:%d' % (date_part, counter)
-
-    hexvalue = hashlib.md5(unique_value.encode('utf-8')).hexdigest()
+def get_uuid(date: datetime.date, counter: int) -> uuid.UUID:
+    unique_value = '%s:%d' % (date.isoformat(), counter)
 
-    return uuid.UUID(hexvalue)
+    return uuid.UUID(bytes=hashlib.md5(unique_value.encode('utf-8')).digest())
 
 
 def get_vtimezone() -> icalendar.cal.Timezone:
@@ -149,45 +180,58 @@ def get_vtimezone() -> icalendar.cal.Timezone:
     daylight.add('tzname', 'CEST')
     daylight.add('tzoffsetfrom', datetime.timedelta(hours=1))
     daylight.add('tzoffsetto', datetime.timedelta(hours=2))
-    daylight.add('dtstart', datetime.datetime.fromtimestamp(0))
+    daylight.add('dtstart', _EPOCH)
     daylight.add('rrule', {'freq': 'YEARLY', 'bymonth': 3, 'byday': '-1SU'})
     tz.add_component(daylight)
     standard = icalendar.cal.TimezoneStandard()
     standard.add('tzname', 'CET')
     standard.add('tzoffsetfrom', datetime.timedelta(hours=2))
     standard.add('tzoffsetto', datetime.timedelta(hours=1))
-    standard.add('dtstart', datetime.datetime.fromtimestamp(0))
+    standard.add('dtstart', _EPOCH)
     standard.add('rrule', {'freq': 'YEARLY', 'bymonth': 10, 'byday': '-1SU'})
     tz.add_component(standard)
 
     return tz
 
 
-def eventdata_to_calendar(eventdata_list: List[Dict[str, any]]) -> icalendar.Calendar:
+# The timezone definition is constant, so build it once and share it
+_VTIMEZONE = get_vtimezone()
+
+
+def eventdata_to_calendar(eventdata_list: List[Event]) -> icalendar.Calendar:
     calendar = icalendar.Calendar()
 
     calendar.add('prodid', '-//grundfoskoret-calendar//grundfoskoret.dk//')
     calendar.add('version', '2.0')
-    calendar.add_component(get_vtimezone())
+    calendar.add_component(_VTIMEZONE)
 
-    now = TIMEZONE.localize(datetime.datetime.now())
+    now = datetime.datetime.now().replace(tzinfo=TIMEZONE)
     sequence = int(now.strftime('%y%m%d%H%M'))
 
-    event_counters = {}
+    # With the events grouped by day the UID counter only has to be reset
+    # when the day changes. The sort is stable, so events on the same day
+    # keep their page order and thereby their UIDs.
+    previous_day = None
+    counter = 0
 
-    for eventdata in eventdata_list:
+    for eventdata in sorted(eventdata_list, key=lambda e: e.start.date()):
         event = icalendar.Event()
 
-        start_date = eventdata['start']
+        start_date = eventdata.start
+        day = start_date.date()
+        if day != previous_day:
+            previous_day = day
+            counter = 0
+        counter += 1
 
-        event.add('uid', get_uuid(start_date, event_counters))
-        event.add('summary', eventdata['title'])
+        event.add('uid', get_uuid(day, counter))
+        event.add('summary', eventdata.title)
         event.add('dtstamp', now)
         event.add('dtstart', start_date)
-        event.add('dtend', eventdata['end'])
+        event.add('dtend', eventdata.end)
         event.add('sequence', sequence)
 
-        if eventdata['cancelled']:
+        if eventdata.cancelled:
             event.add('method', 'CANCEL')
             event.add('status', 'CANCELLED')
 
@@ -197,18 +241,29 @@ def eventdata_to_calendar(eventdata_list: List[Dict[str, any]]) -> icalendar.Cal
 
 
 def write_calendar_to_file(calendar: icalendar.Calendar) -> None:
-    with open(ICS_FILENAME, 'wb') as f:
+    # Write to a temporary file and move it into place, so readers never
+    # see a partially written calendar
+    tmp_filename = ICS_FILENAME + '.tmp'
+    with open(tmp_filename, 'wb') as f:
         f.write(calendar.to_ical())
 
+    os.replace(tmp_filename, ICS_FILENAME)
+
 
 def main() -> None:
 
-    response = requests.post(CALENDAR_PAGE_URL, data={
+    response = SESSION.post(CALENDAR_PAGE_URL, data={
         "frontend_login_username": USERNAME,
         "frontend_login_password": PASSWORD
-    })
+    }, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    # A rejected login serves the login form again instead of the calendar
+    if 'frontend_login_password' in response.text:
+        raise RuntimeError('Login to %s failed' % CALENDAR_PAGE_URL)
 
     eventdata = parse_events(response.text)
+
     calendar = eventdata_to_calendar(eventdata)
     write_calendar_to_file(calendar)
 